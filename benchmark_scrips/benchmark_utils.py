@@ -4,7 +4,10 @@ import logging
 import os
 import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from csv import writer
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
@@ -15,12 +18,43 @@ from pyesgf.search import SearchConnection
 
 sys.path.append("..")
 
-from constants import OBSERVATION_DATA_PATHS, SSP_EXPERIMENT, VARIABLE_FREQUENCY_GROUP
+from constants import (
+    OBSERVATION_DATA_PATHS,
+    REPO_ROOT,
+    SSP_EXPERIMENT,
+    VARIABLE_FREQUENCY_GROUP,
+)
 from utils import download_file, standardize_dims
 
 logger = logging.getLogger(__name__)
 
 
+_CATALOGUE_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _read_cmip6_catalogue() -> pd.DataFrame:
+    # download because it is slow to read from GCS. should save locally for future runs
+    cmip6_catalogue = "pangeo-cmip6.csv"
+    if not os.path.exists(cmip6_catalogue):
+        download_file(
+            "https://cmip6.storage.googleapis.com/pangeo-cmip6.csv", cmip6_catalogue
+        )
+    return pd.read_csv(cmip6_catalogue)
+
+
+def load_cmip6_catalogue() -> pd.DataFrame:
+    """Read the pangeo cmip6 catalogue csv once per process, downloading it on first use.
+    The returned DataFrame is shared between callers and should not be modified in place.
+
+    Returns:
+        pd.DataFrame: pangeo cmip6 catalogue
+    """
+    # lock so concurrent first calls wait for one download and read
+    with _CATALOGUE_LOCK:
+        return _read_cmip6_catalogue()
+
+
 def search_gcs(filters: dict, drop_older_versions: bool) -> pd.DataFrame:
     """Look for files in the public cmip6 google cloud bucket. Uses csv of data info to find path instead of a glob. Since files are saved as zarr, glob would return too many.
     Broken out from DataFinder class to make the gcs search more customizable for model variable data vs model cell area data.
@@ -32,22 +66,20 @@ def search_gcs(filters: dict, drop_older_versions: bool) -> pd.DataFrame:
     Returns:
         pd.DataFrame: datasets matching filters on google cloud
     """
-    # download because it is slow to read from GCS. should save locally for future runs
-    cmip6_catalogue = "pangeo-cmip6.csv"
-    if os.path.exists(cmip6_catalogue):
-        df = pd.read_csv(cmip6_catalogue)
-    else:
-        download_file(
-            "https://cmip6.storage.googleapis.com/pangeo-cmip6.csv", cmip6_catalogue
-        )
+    df = load_cmip6_catalogue()
 
-    for column, value in filters.items():
-        df = df[df[column] == value]
+    # combine the filters into one mask so the catalogue is only indexed once
+    mask = np.logical_and.reduce(
+        [df[column].to_numpy() == value for column, value in filters.items()]
+        + [np.ones(len(df), dtype=bool)]
+    )
+    df = df[mask]
 
     if drop_older_versions:
-        df["version_date"] = pd.to_datetime(df["version"], format="%Y%m%d")
+        # assign returns a new frame, the cached catalogue is never modified
         df = (
-            df.sort_values("version_date", ascending=False)
+            df.assign(version_date=pd.to_datetime(df["version"], format="%Y%m%d"))
+            .sort_values("version_date", ascending=False)
             .drop_duplicates(
                 [
                     "activity_id",
@@ -107,10 +139,8 @@ class DataFinder:
         )
         self.grid = "gr" if self.variable_frequency_table == "Omon" else "gn"
 
-        self.obs_data_path_local = (
-            "/".join(os.getcwd().split("/")[:-1])
-            + "/"
-            + OBSERVATION_DATA_PATHS[self.variable]["local"]
+        self.obs_data_path_local = str(
+            REPO_ROOT / OBSERVATION_DATA_PATHS[self.variable]["local"]
         )
         self.obs_data_path_cloud = OBSERVATION_DATA_PATHS[self.variable]["cloud"]
         self.ensemble_members = None
@@ -223,12 +253,8 @@ class DataFinder:
 
         else:
             results = ctx.search()
-            file_url_list = []
             files = results[0].file_context().search()
-            for file in files:
-                file_url_list.append(file.opendap_url)
-            df = pd.DataFrame(file_url_list, columns=["file_url"])
-            return df["file_url"].tolist()
+            return [file.opendap_url for file in files]
 
     def read_data(
         self,
@@ -269,11 +295,15 @@ class DataFinder:
                         f"can't find data for {mip}, {self.model}, {experiment}, {ensemble}, {frequency_table}, {variable}"
                     )
                 else:
-                    # read data from esgf
-                    ds_list = []
-                    for file in esgf_file_path:
-                        ds_list.append(xr.open_dataset(file))
-                    ds = xr.concat(ds_list)
+                    # read data from esgf, opening the opendap urls concurrently
+                    ds = xr.open_mfdataset(
+                        esgf_file_path,
+                        combine="by_coords",
+                        parallel=True,
+                        data_vars="minimal",
+                        coords="minimal",
+                        compat="override",
+                    )
             else:
                 # read from google storage
                 # gcs should only return one path since zarr, not folder of netCDFs
@@ -296,11 +326,15 @@ class DataFinder:
         Returns:
             xr.Dataset: Ensemble mean of climate model data
         """
-        ensemble_ds_list = []
         if self.ensemble_members is None:
             ensemble_members = self.find_ensemble_members(experiment=experiment)
             self.ensemble_members = ensemble_members
-        for ensemble in self.ensemble_members:
+        if not self.ensemble_members:
+            raise ValueError(
+                f"No ensemble members found for model {self.model}, variable {self.variable}, experiment {experiment}"
+            )
+
+        def read_member(ensemble):
             ds = self.read_data(
                 mip=mip,
                 experiment=experiment,
@@ -313,8 +347,13 @@ class DataFinder:
                 errors="ignore",
             )
             ds = standardize_dims(ds)
-            ds = ds.expand_dims({"ensemble": [ensemble]})
-            ensemble_ds_list.append(ds)
+            return ds.expand_dims({"ensemble": [ensemble]})
+
+        # opening a member is mostly waiting on storage, so open them concurrently
+        with ThreadPoolExecutor(
+            max_workers=min(8, len(self.ensemble_members))
+        ) as executor:
+            ensemble_ds_list = list(executor.map(read_member, self.ensemble_members))
         model_ens_ds = xr.concat(
             ensemble_ds_list, dim="ensemble", combine_attrs="override"
         )
@@ -343,6 +382,22 @@ class DataFinder:
         self.model_ds = model_ds
         return self.model_ds
 
+    def set_model_ds(self, ds: xr.Dataset, ensemble_members: list) -> xr.Dataset:
+        """Use model data already read for a longer period (e.g. by another DataFinder) instead of reading it again.
+
+        Args:
+            ds (xr.Dataset): Model data covering this DataFinder's time period
+            ensemble_members (list): Ensemble members ds was built from, used to find cell area data
+
+        Returns:
+            xr.Dataset: Model data sliced to this DataFinder's time period
+        """
+        self.ensemble_members = ensemble_members
+        self.model_ds = ds.sel(
+            time=slice(f"{self.start_year}-01-01", f"{self.end_year}-12-31")
+        )
+        return self.model_ds
+
     def load_cell_area_ds(self) -> xr.DataArray:
         """Reads model cell area data. fx if atmospheric variable, Ofx if ocean variable. If data not found, prints warning and returns none. Can use cos(lat) as proxy for cell area. Passed through standardizer function to make sure dims are named correctly.
 
@@ -368,7 +423,8 @@ class DataFinder:
             if "_FillValue" in fx_ds[self.area_variable_name].encoding:
                 fill_val = fx_ds[self.area_variable_name].encoding["_FillValue"]
                 fx_ds = fx_ds.where(fx_ds[self.area_variable_name] <= fill_val)
-            self.fx_ds = standardize_dims(fx_ds)[self.area_variable_name]
+            # small 2d field reused by every metric, read it into memory once
+            self.fx_ds = standardize_dims(fx_ds)[self.area_variable_name].load()
         except:
             logger.warning(
                 "No areacella/o data found. Using cos(lat) for cell weights."
@@ -406,14 +462,7 @@ class DataFinder:
         self,
         experiment: str,
     ) -> list:
-        # download because it is slow to read from GCS. should save locally for future runs
-        cmip6_catalogue = "pangeo-cmip6.csv"
-        if os.path.exists(cmip6_catalogue):
-            df = pd.read_csv(cmip6_catalogue)
-        else:
-            download_file(
-                "https://cmip6.storage.googleapis.com/pangeo-cmip6.csv", cmip6_catalogue
-            )
+        df = load_cmip6_catalogue()
 
         query = dict(
             experiment_id=experiment,
@@ -447,6 +496,17 @@ def bias_adjustment(model, obs):
     return model - adjustment
 
 
+# direct rmse/mae for short time series, skips xskillscore's apply_ufunc dispatch
+def time_rmse(a, b):
+    """Root mean square error of a against b along time, ignoring NaNs."""
+    return np.sqrt(((a - b) ** 2).mean(dim="time", skipna=True, keep_attrs=True))
+
+
+def time_mae(a, b):
+    """Mean absolute error of a against b along time, ignoring NaNs."""
+    return abs(a - b).mean(dim="time", skipna=True, keep_attrs=True)
+
+
 class MetricCalculation:
     """The MetricCalculation class is for benchmarking climate model data against observations. It takes in model, observations, and weights datasets.
     The weights dataset should be the cell area.
@@ -488,6 +548,8 @@ class MetricCalculation:
         weights = weights.where(weights.lat < lat_max)
 
         self.weights = weights
+        # weights with out of bound cells zeroed, built once for the weighted reductions
+        self.filled_weights = weights.fillna(0)
 
         self.model_zonal_mean = None
         self.obs_zonal_mean = None
@@ -506,7 +568,7 @@ class MetricCalculation:
             xr.Dataset: zonal mean of model dataset
             xr.Dataset: zonal mean of observations dataset
         """
-        weighted_ds = ds.weighted(self.weights.fillna(0)).mean(
+        weighted_ds = ds.weighted(self.filled_weights).mean(
             dim=self.spatial_dims, keep_attrs=True
         )
         return weighted_ds
@@ -535,13 +597,7 @@ class MetricCalculation:
             model_rmse_data = anomaly(ds=model_rmse_data)
             obs_rmse_data = anomaly(ds=obs_rmse_data)
 
-        return xs.rmse(
-            a=model_rmse_data.chunk({"time": -1}),
-            b=obs_rmse_data.chunk({"time": -1}),
-            skipna=True,
-            keep_attrs=True,
-            dim=["time"],
-        ).values.tolist()
+        return time_rmse(a=model_rmse_data, b=obs_rmse_data).values.tolist()
 
     def zonal_mean_mae(self, adjustment: str = None) -> float:
         """First calculates the zonal mean of the model and observations datasets, then calculates the MAE of the two time series.
@@ -567,13 +623,7 @@ class MetricCalculation:
             model_rmse_data = anomaly(ds=model_rmse_data)
             obs_rmse_data = anomaly(ds=obs_rmse_data)
 
-        return xs.mae(
-            a=model_rmse_data.chunk({"time": -1}),
-            b=obs_rmse_data.chunk({"time": -1}),
-            skipna=True,
-            keep_attrs=True,
-            dim=["time"],
-        ).values.tolist()
+        return time_mae(a=model_rmse_data, b=obs_rmse_data).values.tolist()
 
     def zonal_mean_crps(self, adjustment: str = None) -> float:
         """First calculates the zonal mean of the model and observations datasets, then calculates the CRPS of the two time series.
@@ -692,7 +742,7 @@ class MetricCalculation:
         return xs.crps_ensemble(
             forecasts=model_rmse_data.chunk({"time": -1, "ensemble": -1}),
             observations=obs_rmse_data.chunk({"time": -1}),
-            weights=self.weights.fillna(0),
+            weights=self.filled_weights,
             member_dim="ensemble",
             keep_attrs=True,
             dim=self.spatial_dims,
@@ -726,6 +776,16 @@ class MetricCalculation:
         )
 
 
+@lru_cache(maxsize=1)
+def get_storage_client() -> storage.Client:
+    """Create the google cloud storage client once per process and reuse it
+
+    Returns:
+        storage.Client: google cloud storage client
+    """
+    return storage.Client(project="JCM and Benchmarking")
+
+
 class SaveResults:
     """The SaveResults class is for saving outputs from the benchmarking pipeline in an organized mannor.
     Options for saving data as csv and zarr.
@@ -771,12 +831,20 @@ class SaveResults:
             else f"{self.metric}_{self.adjustment}"
         )
 
-        self.storage_client = storage.Client(project="JCM and Benchmarking")
         self.bucket_name = "climatebench"
-        self.bucket = self.storage_client.bucket(self.bucket_name)
         self.gcs_prefix = f"gs://{self.bucket_name}/"
         self.data_path = f"../results/{self.variable}/"
 
+    @property
+    def storage_client(self) -> storage.Client:
+        """Shared google cloud storage client, only created when saving to the cloud"""
+        return get_storage_client()
+
+    @property
+    def bucket(self) -> storage.Bucket:
+        """Results bucket on google cloud"""
+        return self.storage_client.bucket(self.bucket_name)
+
     def write_data(self, results, save_to_cloud: bool):
         """Save data. Datatype determines how data is saved. Options are csv for float, and zarr for xr.DataArray
 
@@ -835,15 +903,14 @@ class SaveResults:
                 result_df.to_csv(full_gcs_path, index=False)
             logger.info(f"Results saved to cloud: {full_gcs_path}")
         else:
-            if os.path.isfile(file_path):
-                with open(file_path, "a") as f_object:
-                    writer_object = writer(f_object)
-                    writer_object.writerow(result_df.values.flatten().tolist())
-                    f_object.close()
-            else:
-                if not os.path.exists(self.data_path):
-                    os.makedirs(self.data_path)
-                result_df.to_csv(file_path, index=False)
+            os.makedirs(self.data_path, exist_ok=True)
+            # append, only writing the header when the file is new
+            result_df.to_csv(
+                file_path,
+                mode="a",
+                header=not os.path.isfile(file_path),
+                index=False,
+            )
 
             logger.info(f"Results saved locally: {file_path}")
 
@@ -856,19 +923,14 @@ class SaveResults:
             save_to_cloud (bool): Save to cloud if passed. Default is False.
         """
         file_name = f"{self.model}_{self.metric}_{self.lat_min}_{self.lat_max}_{self.start_year}_{self.end_year}_results.zarr"
-        ds = ds.to_dataset(name=self.data_label)
-        for var in list(ds.data_vars) + list(ds.coords):
-            ds[var].encoding = {}
+        ds = ds.to_dataset(name=self.data_label).drop_encoding()
         # file name should be org_model_....
         file_path = self.data_path + file_name
         if save_to_cloud:
             file_path = self.gcs_prefix + file_path
-        chunks = {}
-        for dim in ds.dims:
-            chunks[dim] = -1
-        ds = ds.chunk(chunks)
-        # save
-        ds.to_zarr(file_path, mode="a")
+        ds = ds.chunk(-1)
+        # save, consolidating metadata so readers fetch a single metadata object
+        ds.to_zarr(file_path, mode="a", consolidated=True)
         logger.info(f"data saved: {file_path}")
 
     def overwrite(self, save_to_cloud: bool = False):
@@ -885,10 +947,14 @@ class SaveResults:
                 print(f"Blob {blob.name} deleted.")
         else:
             # remove local files
-            local_files = glob.glob(self.data_path + "*")
-            for file in local_files:
-                logger.info(f"deleting file: {file}")
-                if file[-4:] == "zarr":
-                    shutil.rmtree(file)
-                else:
-                    os.remove(file)
+            if not os.path.isdir(self.data_path):
+                return
+            with os.scandir(self.data_path) as entries:
+                entries = list(entries)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and entry.name.endswith(".zarr"):
+                    logger.info(f"deleting file: {entry.path}")
+                    shutil.rmtree(entry.path)
+                elif entry.is_file():
+                    logger.info(f"deleting file: {entry.path}")
+                    os.remove(entry.path)
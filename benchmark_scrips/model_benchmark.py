@@ -1,22 +1,83 @@
 import argparse
+import hashlib
 import logging
 import os
 import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import gsw
+import numpy as np
 import xarray as xr
 import xesmf as xe
 
 from benchmark_utils import DataFinder, MetricCalculation, SaveResults
 
+sys.path.append("..")
+
+from constants import REPO_ROOT
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+REGRID_WEIGHTS_DIR = REPO_ROOT / "benchmark_scrips" / "regrid_weights"
+# ESMF weight generation is not thread safe
+_REGRIDDER_LOCK = threading.Lock()
+
+
+def get_regridder(
+    obs_ds: xr.Dataset, model_ds: xr.Dataset, method: str = "bilinear"
+) -> xe.Regridder:
+    """Build the obs -> model regridder, reusing weights saved by previous runs on the same pair of grids.
+
+    Args:
+        obs_ds (xr.Dataset): Observations on the source grid
+        model_ds (xr.Dataset): Model data on the destination grid
+        method (str): xESMF regridding method. Defaults to "bilinear".
+
+    Returns:
+        xe.Regridder: Regridder from the observation grid to the model grid
+    """
+    grid_hash = hashlib.blake2b(method.encode(), digest_size=16)
+    for ds in [obs_ds, model_ds]:
+        for coord in ["lat", "lon"]:
+            grid_hash.update(ds[coord].values.tobytes())
+    os.makedirs(REGRID_WEIGHTS_DIR, exist_ok=True)
+    weights_path = REGRID_WEIGHTS_DIR / f"{method}_{grid_hash.hexdigest()}.nc"
+
+    if weights_path.exists():
+        logger.info(f"Reusing regridding weights: {weights_path}")
+        return xe.Regridder(
+            obs_ds,
+            model_ds[["lat", "lon"]],
+            method,
+            periodic=True,
+            weights=str(weights_path),
+        )
+
+    regridder = xe.Regridder(obs_ds, model_ds[["lat", "lon"]], method, periodic=True)
+    # xESMF doesn't save weights itself. write to a temporary file and rename it so
+    # concurrent runs never read a partially written file
+    fd, tmp_path = tempfile.mkstemp(
+        dir=REGRID_WEIGHTS_DIR, prefix=f".{weights_path.stem}_", suffix=".nc"
+    )
+    os.close(fd)
+    try:
+        regridder.to_netcdf(tmp_path)
+        os.replace(tmp_path, weights_path)
+        logger.info(f"Saved regridding weights: {weights_path}")
+    except Exception as e:
+        os.remove(tmp_path)
+        logger.warning(f"Could not save regridding weights: {e}")
+    return regridder
+
 
 def main(
     model: str,
     variable: str,
-    metric: str,
+    metrics: list,
     adjustment: str,
     lat_min: int = -90,
     lat_max: int = 90,
@@ -25,137 +86,202 @@ def main(
     ocean_depth: str = None,
     save_to_cloud: bool = False,
     overwrite: bool = False,
+    cache_intermediate: bool = False,
 ):
     logger.info(
-        f"Processing model: {model}, variable: {variable}, metric: {metric}, adjustment: {adjustment}"
+        f"Processing model: {model}, variable: {variable}, metrics: {metrics}, adjustment: {adjustment}"
     )
-    ensemble_mean = False if "crps" in metric else True
+    # crps needs every ensemble member, the other metrics use the ensemble mean
+    ensemble_mean = not any("crps" in metric for metric in metrics)
 
-    temp_dir = "data_cache"
+    # per variable so concurrent runs don't delete each other's cache
+    temp_dir = f"data_cache_{variable}"
     os.makedirs(temp_dir, exist_ok=True)
 
-    if variable == "ohc":
-        data_finder = DataFinder(
-            model=model, variable="thetao", start_year=start_year, end_year=end_year
-        )
-        data_finder_so = DataFinder(
-            model=model, variable="so", start_year=start_year, end_year=end_year
-        )
-        logger.info("Reading model data")
-
-        model_ds = data_finder.load_model_ds(ensemble_mean=ensemble_mean)
-        so_ds = data_finder_so.load_model_ds(ensemble_mean=ensemble_mean)
-        model_ds = xr.merge([model_ds, so_ds])
-
-        logger.info("Reading model cell area data")
-        fx_ds = data_finder.load_cell_area_ds()
-
-        ###### climatology ######
-        logger.info("Reading climatology data")
-        df_thetao_pt1 = DataFinder(
-            model=model, variable="thetao", start_year=2004, end_year=2014
-        )
-        df_thetao_pt2 = DataFinder(
-            model=model, variable="thetao", start_year=2015, end_year=2018
-        )
-        thetao_pt1_ds = df_thetao_pt1.load_model_ds(ensemble_mean=True)
-        thetao_pt2_ds = df_thetao_pt2.load_model_ds(ensemble_mean=True)
-
-        climatology_ds = xr.concat([thetao_pt1_ds, thetao_pt2_ds], dim="time").mean(
-            dim="time"
-        )
-
-        ####### ocean heat content #######
-        logger.info("calculating ocean heat conent")
-        # step 1: convert depth to pressure
-        model_ds["pressure"] = gsw.conversions.p_from_z(
-            z=model_ds["lev"] * -1, lat=model_ds["lat"]
-        )
-
-        # step 2: converty practicacl salinity (ppt) to absolute salinity
-        model_ds["SA"] = gsw.conversions.SA_from_SP(
-            model_ds["so"], model_ds["pressure"], model_ds["lon"], model_ds["lat"]
-        )
-
-        # step 3: convert potential temperature to in situ temp
-        model_ds["CT"] = gsw.conversions.CT_from_pt(model_ds["SA"], model_ds["thetao"])
-        model_ds["t"] = gsw.conversions.t_from_CT(
-            model_ds["SA"], model_ds["CT"], model_ds["pressure"]
-        )
-
-        # step 3.5: convert temperature to temperature anomaly
-        model_ds["thetao_anom"] = model_ds["thetao"] - climatology_ds["thetao"]
-        model_ds["CT_anom"] = gsw.conversions.CT_from_pt(
-            model_ds["SA"], model_ds["thetao_anom"]
-        )
-        model_ds["t_anom"] = gsw.conversions.t_from_CT(
-            model_ds["SA"], model_ds["CT_anom"], model_ds["pressure"]
-        )
-
-        # step 4: calculate density
-        model_ds["rho"] = gsw.density.rho(
-            model_ds["SA"], model_ds["CT"], model_ds["pressure"]
-        )
-
-        # step 5: calculate heat capacity
-        model_ds["cp"] = gsw.cp_t_exact(
-            model_ds["SA"], model_ds["t"], model_ds["pressure"]
-        )
-
-        # step 6: calculate volume
-        model_ds["volume"] = abs(fx_ds * model_ds["lev"].diff(dim="lev"))
-
-        # step 7: calculate heat content
-        model_ds["ohc"] = (
-            model_ds["volume"] * model_ds["rho"] * model_ds["t_anom"] * model_ds["cp"]
-        )
-
-        # step 8: integrate over ocean depth
-        model_deep_ds = (
-            model_ds["ohc"]
-            .sel(lev=slice(0, 2000))
-            .sum(dim="lev")
-            .expand_dims({"layer": ["deep"]})
-        )
-        model_mixed_ds = (
-            model_ds["ohc"]
-            .sel(lev=slice(0, 100))
-            .sum(dim="lev")
-            .expand_dims({"layer": ["mixed"]})
-        )
-        model_integrated_ds = xr.concat(
-            [model_mixed_ds, model_deep_ds], dim="layer"
-        ).drop_encoding()
-
-        # step 9: cache model data
-        logger.info(f"caching model data in {temp_dir}")
-        data_cache_file_path = f"{temp_dir}/model_ohc.zarr"
-        model_integrated_ds.chunk(
-            {"layer": 1, "lat": -1, "lon": -1, "time": 100}
-        ).to_zarr(data_cache_file_path)
-
-        model_ds = xr.open_zarr(data_cache_file_path, chunks={})
-
-    else:
-
-        data_finder = DataFinder(
-            model=model, variable=variable, start_year=start_year, end_year=end_year
-        )
-
-        logger.info("Reading model data")
-        model_ds = data_finder.load_model_ds(ensemble_mean=ensemble_mean)
-        logger.info("Reading model cell area data")
-        fx_ds = data_finder.load_cell_area_ds()
-
-    logger.info("Reading observations")
-    obs_ds = data_finder.load_obs_ds()
+    # the context manager shuts the pool down even if loading the model fails
+    with ThreadPoolExecutor(max_workers=1) as obs_executor:
+        if variable == "ohc":
+            data_finder = DataFinder(
+                model=model, variable="thetao", start_year=start_year, end_year=end_year
+            )
+            # observations don't depend on the model data, open them while it loads
+            obs_future = obs_executor.submit(data_finder.load_obs_ds)
+            data_finder_so = DataFinder(
+                model=model, variable="so", start_year=start_year, end_year=end_year
+            )
+            # the 2004-2018 climatology spans both experiments. each finder is extended
+            # to cover the benchmark period if it falls in its experiment, so thetao is
+            # only read once for the experiment shared with the benchmark
+            df_thetao_hist = DataFinder(
+                model=model,
+                variable="thetao",
+                start_year=min(data_finder.start_year, 2004),
+                end_year=2014,
+            )
+            df_thetao_ssp = DataFinder(
+                model=model,
+                variable="thetao",
+                start_year=2015,
+                end_year=max(data_finder.end_year, 2018),
+            )
+            climatology_periods = [
+                (df_thetao_hist, slice("2004-01-01", "2014-12-31")),
+                (df_thetao_ssp, slice("2015-01-01", "2018-12-31")),
+            ]
+            df_thetao_shared = (
+                df_thetao_hist if data_finder.mip == "CMIP" else df_thetao_ssp
+            )
+
+            logger.info("Reading model data")
+            thetao_shared_ds = df_thetao_shared.load_model_ds(
+                ensemble_mean=ensemble_mean
+            )
+            model_ds = data_finder.set_model_ds(
+                thetao_shared_ds, ensemble_members=df_thetao_shared.ensemble_members
+            )
+            so_ds = data_finder_so.load_model_ds(ensemble_mean=ensemble_mean)
+            model_ds = xr.merge([model_ds, so_ds])
+
+            logger.info("Reading model cell area data")
+            fx_ds = data_finder.load_cell_area_ds()
+
+            ###### climatology ######
+            logger.info("Reading climatology data")
+            if not ensemble_mean:
+                thetao_shared_ds = thetao_shared_ds.mean(dim="ensemble")
+            climatology_parts = []
+            for df_thetao, period in climatology_periods:
+                if df_thetao.mip == data_finder.mip:
+                    thetao_ds = thetao_shared_ds
+                else:
+                    thetao_ds = df_thetao.load_model_ds(ensemble_mean=True)
+                climatology_parts.append(thetao_ds.sel(time=period))
+
+            climatology_ds = xr.concat(climatology_parts, dim="time").mean(dim="time")
+
+            ####### ocean heat content #######
+            logger.info("calculating ocean heat conent")
+            # step 1: convert depth to pressure
+            model_ds["pressure"] = gsw.conversions.p_from_z(
+                z=model_ds["lev"] * -1, lat=model_ds["lat"]
+            )
+
+            # step 2: converty practicacl salinity (ppt) to absolute salinity
+            model_ds["SA"] = gsw.conversions.SA_from_SP(
+                model_ds["so"], model_ds["pressure"], model_ds["lon"], model_ds["lat"]
+            )
+
+            # step 3: convert potential temperature to in situ temp
+            model_ds["CT"] = gsw.conversions.CT_from_pt(
+                model_ds["SA"], model_ds["thetao"]
+            )
+            model_ds["t"] = gsw.conversions.t_from_CT(
+                model_ds["SA"], model_ds["CT"], model_ds["pressure"]
+            )
+
+            # step 3.5: convert temperature to temperature anomaly
+            model_ds["thetao_anom"] = model_ds["thetao"] - climatology_ds["thetao"]
+            model_ds["CT_anom"] = gsw.conversions.CT_from_pt(
+                model_ds["SA"], model_ds["thetao_anom"]
+            )
+            model_ds["t_anom"] = gsw.conversions.t_from_CT(
+                model_ds["SA"], model_ds["CT_anom"], model_ds["pressure"]
+            )
+
+            # step 4: calculate density
+            model_ds["rho"] = gsw.density.rho(
+                model_ds["SA"], model_ds["CT"], model_ds["pressure"]
+            )
+
+            # step 5: calculate heat capacity
+            model_ds["cp"] = gsw.cp_t_exact(
+                model_ds["SA"], model_ds["t"], model_ds["pressure"]
+            )
+
+            # step 6: calculate volume
+            # lev is a small 1-D coordinate, compute the layer thickness outside the
+            # dask graph
+            lev = model_ds["lev"].values
+            lev_thickness = xr.DataArray(
+                np.abs(np.diff(lev)), dims=["lev"], coords={"lev": lev[1:]}
+            )
+            model_ds["volume"] = abs(fx_ds) * lev_thickness
+
+            # step 7: calculate heat content
+            model_ds["ohc"] = (
+                model_ds["volume"]
+                * model_ds["rho"]
+                * model_ds["t_anom"]
+                * model_ds["cp"]
+            )
+
+            # step 8: integrate over ocean depth
+            # mask both layers at once so the ohc array is only read once
+            lev_da = model_ds["lev"]
+            layer_mask = xr.concat(
+                [
+                    ((lev_da >= 0) & (lev_da <= 100)).expand_dims({"layer": ["mixed"]}),
+                    ((lev_da >= 0) & (lev_da <= 2000)).expand_dims({"layer": ["deep"]}),
+                ],
+                dim="layer",
+            )
+            model_integrated_ds = (
+                model_ds["ohc"]
+                .where(layer_mask)
+                .sum(dim="lev")
+                .transpose("layer", ...)
+                .astype(np.float32)
+                .drop_encoding()
+                .to_dataset(name="ohc")
+            )
+
+            # step 9: cache model data
+            # each dask chunk is written as one zarr shard holding yearly chunks,
+            # dims other than layer and time (incl. ensemble for crps) stay whole
+            ohc_dims = model_integrated_ds["ohc"].dims
+            shard_size = {
+                dim: {"layer": 1, "time": 120}.get(dim, -1) for dim in ohc_dims
+            }
+            model_integrated_ds = model_integrated_ds.chunk(shard_size)
+            if cache_intermediate:
+                logger.info(f"caching model data in {temp_dir}")
+                data_cache_file_path = f"{temp_dir}/model_ohc.zarr"
+                sizes = model_integrated_ds.sizes
+                zarr_chunks = tuple(
+                    {"layer": 1, "time": 12}.get(dim, sizes[dim]) for dim in ohc_dims
+                )
+                zarr_shards = tuple(
+                    {"layer": 1, "time": 120}.get(dim, sizes[dim]) for dim in ohc_dims
+                )
+                model_integrated_ds.to_zarr(
+                    data_cache_file_path,
+                    zarr_format=3,
+                    encoding={"ohc": {"chunks": zarr_chunks, "shards": zarr_shards}},
+                )
+                model_ds = xr.open_zarr(data_cache_file_path, chunks={})
+            else:
+                model_ds = model_integrated_ds.persist()
+
+        else:
+
+            data_finder = DataFinder(
+                model=model, variable=variable, start_year=start_year, end_year=end_year
+            )
+            obs_future = obs_executor.submit(data_finder.load_obs_ds)
+
+            logger.info("Reading model data")
+            model_ds = data_finder.load_model_ds(ensemble_mean=ensemble_mean)
+            logger.info("Reading model cell area data")
+            fx_ds = data_finder.load_cell_area_ds()
+
+        logger.info("Reading observations")
+        obs_ds = obs_future.result()
     ensemble_members = data_finder.ensemble_members
 
     logger.info("Regridding observations")
     # regrid obs data to the model grid
-    regridder = xe.Regridder(
-        obs_ds, model_ds[["lat", "lon"]], "bilinear", periodic=True
-    )
+    with _REGRIDDER_LOCK:
+        regridder = get_regridder(obs_ds, model_ds)
     obs_rg_ds = regridder(obs_ds[variable], keep_attrs=True)
 
     # select ocean depth layer
@@ -163,38 +289,45 @@ def main(
         obs_rg_ds = obs_rg_ds.sel(layer=ocean_depth)
         model_ds = model_ds.sel(layer=ocean_depth)
 
-    # set up metric calculation class
-    metric_calculator = MetricCalculation(
-        observations=obs_rg_ds,
-        model=model_ds[variable],
-        weights=fx_ds,
-        lat_min=lat_min,
-        lat_max=lat_max,
-    )
-
-    logger.info(f"Calculating {adjustment} {metric}")
-    result = getattr(metric_calculator, metric)(adjustment=adjustment)
-
     var_save_name = variable if ocean_depth is None else f"{variable}_{ocean_depth}"
 
-    # set up data save class
-    save_results = SaveResults(
-        model=model,
-        variable=var_save_name,
-        ensemble_members=ensemble_members,
-        metric=metric,
-        adjustment=adjustment,
-        start_year=start_year,
-        end_year=end_year,
-        lat_max=lat_max,
-        lat_min=lat_min,
-    )
-    # if overwrite paramter is set, delete files in the save path
-    if overwrite:
-        logger.info(f"Deleting stale data in: {save_results.data_path}")
-        save_results.overwrite(save_to_cloud=save_to_cloud)
+    # the model and obs data are loaded once and shared by every metric
+    for i, metric in enumerate(metrics):
+        model_da = model_ds[variable]
+        if "crps" not in metric and "ensemble" in model_da.dims:
+            model_da = model_da.mean(dim="ensemble")
+
+        # set up metric calculation class
+        metric_calculator = MetricCalculation(
+            observations=obs_rg_ds,
+            model=model_da,
+            weights=fx_ds,
+            lat_min=lat_min,
+            lat_max=lat_max,
+        )
+
+        logger.info(f"Calculating {adjustment} {metric}")
+        result = getattr(metric_calculator, metric)(adjustment=adjustment)
+
+        # set up data save class
+        save_results = SaveResults(
+            model=model,
+            variable=var_save_name,
+            ensemble_members=ensemble_members,
+            metric=metric,
+            adjustment=adjustment,
+            start_year=start_year,
+            end_year=end_year,
+            lat_max=lat_max,
+            lat_min=lat_min,
+        )
+        # if overwrite paramter is set, delete files in the save path before the
+        # first metric is written
+        if overwrite and i == 0:
+            logger.info(f"Deleting stale data in: {save_results.data_path}")
+            save_results.overwrite(save_to_cloud=save_to_cloud)
 
-    save_results.write_data(results=result, save_to_cloud=save_to_cloud)
+        save_results.write_data(results=result, save_to_cloud=save_to_cloud)
 
     # delete temp files
     if os.path.exists(temp_dir):
@@ -211,7 +344,9 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--variable",
-        help="Input value for the main function",
+        nargs="+",
+        required=True,
+        help="Variables to benchmark. Several variables are run concurrently.",
         choices=[
             "tas",
             "pr",
@@ -228,6 +363,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--metric",
         required=True,
+        nargs="+",
         choices=[
             "zonal_mean_rmse",
             "zonal_mean_mae",
@@ -237,7 +373,7 @@ if __name__ == "__main__":
             "spatial_crps",
             "temporal_rmse",
         ],
-        help="Metric to calculate. Must be a member of the MetricCalculation class.",
+        help="Metrics to calculate. Must be members of the MetricCalculation class.",
     )
     parser.add_argument(
         "--adjustment",
@@ -288,12 +424,19 @@ if __name__ == "__main__":
         choices=["deep", "mixed"],
         help="Relevant for ocean heat content benchmark. mixed = 100m, deep = 2,000 m.",
     )
+    parser.add_argument(
+        "--cache_intermediate",
+        action="store_true",
+        default=False,
+        help="Write the intermediate ocean heat content data to a zarr cache instead of keeping it in memory.",
+    )
     args = parser.parse_args()
+    # intern so constant lookups keyed on the variable name compare by identity
+    variables = [sys.intern(variable) for variable in args.variable]
 
-    main(
+    kwargs = dict(
         model=args.model,
-        variable=args.variable,
-        metric=args.metric,
+        metrics=args.metric,
         adjustment=args.adjustment,
         lat_min=args.lat_min,
         lat_max=args.lat_max,
@@ -302,4 +445,24 @@ if __name__ == "__main__":
         ocean_depth=args.ocean_depth,
         save_to_cloud=args.save_to_cloud,
         overwrite=args.overwrite,
+        cache_intermediate=args.cache_intermediate,
     )
+    if len(variables) == 1:
+        main(variable=variables[0], **kwargs)
+    else:
+        # variables are independent and mostly wait on storage, run them in one
+        # process so imports, clients and cached catalogues are shared
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(variables)) as executor:
+            futures = {
+                executor.submit(main, variable=variable, **kwargs): variable
+                for variable in variables
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Benchmark failed for {futures[future]}: {e}")
+                    failed.append(futures[future])
+        if failed:
+            raise RuntimeError(f"Benchmark failed for: {', '.join(failed)}")
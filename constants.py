@@ -1,3 +1,9 @@
+from pathlib import Path
+from types import MappingProxyType
+
+# data paths in the specs below are relative to the repository root
+REPO_ROOT = Path(__file__).resolve().parent
+
 VARIABLE_FREQUENCY_GROUP = {
     "tas": "Amon",
     "pr": "Amon",
@@ -222,49 +228,25 @@ OBSERVATION_DATA_SPECS = {
 }
 
 # using nested dict incase we have multiple obs datasets for one var. This dict should use the main obs dataset.
-OBSERVATION_DATA_PATHS = {
-    "tas": {
-        "cloud": OBSERVATION_DATA_SPECS["tas"]["HadCRUT5"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["tas"]["HadCRUT5"]["local_path"],
-    },
-    "tos": {
-        "cloud": OBSERVATION_DATA_SPECS["tos"]["noaa_oisst"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["tos"]["noaa_oisst"]["local_path"],
-    },
-    "pr": {
-        "cloud": OBSERVATION_DATA_SPECS["pr"]["noaa_gpcp"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["pr"]["noaa_gpcp"]["local_path"],
-    },
-    "clt": {
-        "cloud": OBSERVATION_DATA_SPECS["clt"]["nasa_modis"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["clt"]["nasa_modis"]["local_path"],
-    },
-    "od550aer": {
-        "cloud": OBSERVATION_DATA_SPECS["od550aer"]["nasa_modis"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["od550aer"]["nasa_modis"]["local_path"],
-    },
-    "rsut": {
-        "cloud": OBSERVATION_DATA_SPECS["rsut"]["nasa_ceres"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["rsut"]["nasa_ceres"]["local_path"],
-    },
-    "rsutcs": {
-        "cloud": OBSERVATION_DATA_SPECS["rsutcs"]["nasa_ceres"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["rsutcs"]["nasa_ceres"]["local_path"],
-    },
-    "rlut": {
-        "cloud": OBSERVATION_DATA_SPECS["rlut"]["nasa_ceres"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["rlut"]["nasa_ceres"]["local_path"],
-    },
-    "rlutcs": {
-        "cloud": OBSERVATION_DATA_SPECS["rlutcs"]["nasa_ceres"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["rlutcs"]["nasa_ceres"]["local_path"],
-    },
-    "thetao": {
-        "cloud": OBSERVATION_DATA_SPECS["thetao"]["argo"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["thetao"]["argo"]["local_path"],
-    },
-    "so": {
-        "cloud": OBSERVATION_DATA_SPECS["so"]["argo"]["cloud_path"],
-        "local": OBSERVATION_DATA_SPECS["so"]["argo"]["local_path"],
-    },
+_MAIN_OBSERVATION_SOURCE = {
+    "tas": "HadCRUT5",
+    "tos": "noaa_oisst",
+    "pr": "noaa_gpcp",
+    "clt": "nasa_modis",
+    "od550aer": "nasa_modis",
+    "rsut": "nasa_ceres",
+    "rsutcs": "nasa_ceres",
+    "rlut": "nasa_ceres",
+    "rlutcs": "nasa_ceres",
+    "thetao": "argo",
+    "so": "argo",
 }
+OBSERVATION_DATA_PATHS = MappingProxyType(
+    {
+        variable: {
+            "cloud": OBSERVATION_DATA_SPECS[variable][source]["cloud_path"],
+            "local": OBSERVATION_DATA_SPECS[variable][source]["local_path"],
+        }
+        for variable, source in _MAIN_OBSERVATION_SOURCE.items()
+    }
+)
@@ -5,6 +5,7 @@ import os
 import shutil
 import sys
 import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 
 import ee
@@ -19,18 +20,69 @@ from constants import (
     GOOGLE_CLOUD_PROJECT,
     HIST_START_DATE,
     OBSERVATION_DATA_SPECS,
+    REPO_ROOT,
     SSP_END_DATE,
 )
-from utils import download_file, standardize_dims
+from utils import SESSION, download_file, download_to_buffer, standardize_dims
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+MAX_DOWNLOAD_WORKERS = 8
+TARGET_CHUNK_BYTES = 8 * 1024 * 1024
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+# RAM to leave free in /dev/shm after staging downloads there
+MIN_SHM_FREE_BYTES = 8 * 1024**3
+
+_EE_INITIALIZED = False
+
+
+def _temporary_root(required_bytes: int = None):
+    """Use RAM backed /dev/shm for downloads of known size that leave room to spare"""
+    shm = "/dev/shm"
+    if required_bytes is None or not os.path.isdir(shm):
+        return None
+    if shutil.disk_usage(shm).free - required_bytes > MIN_SHM_FREE_BYTES:
+        return shm
+    return None
+
+
+def _content_length(url: str) -> int:
+    """Size of a remote file from a HEAD request, 0 if missing and None if unknown"""
+    try:
+        response = SESSION.head(url, allow_redirects=True, timeout=30)
+    except Exception:
+        return None
+    if response.status_code == 404:
+        return 0
+    if not response.ok or "Content-Length" not in response.headers:
+        return None
+    return int(response.headers["Content-Length"])
+
+
+def _ensure_ee_initialized():
+    """Initialize Earth Engine once per process, authenticating only if needed"""
+    global _EE_INITIALIZED
+    if _EE_INITIALIZED:
+        return
+    try:
+        ee.Initialize(project=GOOGLE_CLOUD_PROJECT)
+    except Exception:
+        # no cached credentials yet
+        ee.Authenticate()
+        ee.Initialize(project=GOOGLE_CLOUD_PROJECT)
+    _EE_INITIALIZED = True
+
 
 @contextmanager
-def temporary_directory():
-    """Context manager for temporary directory"""
-    temp_dir = tempfile.mkdtemp()
+def temporary_directory(required_bytes: int = None):
+    """Context manager for temporary directory
+
+    Args:
+        required_bytes (int): Expected size of the files written to it. tmpfs is only
+            used when this is known.
+    """
+    temp_dir = tempfile.mkdtemp(dir=_temporary_root(required_bytes))
     try:
         yield temp_dir
     finally:
@@ -52,9 +104,7 @@ class DownloadObservations:
             )
 
         self.data_specs = OBSERVATION_DATA_SPECS[self.variable][self.source]
-        self.local_data_path = (
-            "/".join(os.getcwd().split("/")[:-1]) + "/" + self.data_specs["local_path"]
-        )
+        self.local_data_path = str(REPO_ROOT / self.data_specs["local_path"])
         self.cloud_data_path = self.data_specs["cloud_path"]
         self.source_var_name = self.data_specs["source_var_name"]
 
@@ -69,7 +119,7 @@ class DownloadObservations:
         """Download raw data based on data specifications"""
         logger.info(f"Starting download for {self.variable} from {self.source}")
 
-        with temporary_directory() as temp_dir:
+        with temporary_directory(self._estimate_download_bytes()) as temp_dir:
             if self.data_specs.get("download_url"):
                 ds = self._download_from_url(temp_dir)
             elif self.data_specs.get("gee_image_collection"):
@@ -84,12 +134,30 @@ class DownloadObservations:
                 )
         self.ds_raw = standardize_dims(ds)
 
+    def _multiple_download_urls(self) -> list:
+        """URLs of the yearly files of a multi-file source"""
+        start_year, end_year = self.data_specs["file_date_range"]
+        return [
+            self.data_specs["download_url"].format(year)
+            for year in range(start_year, end_year)
+        ]
+
+    def _estimate_download_bytes(self) -> int:
+        """Total size of the files staged in the temporary directory, None if unknown"""
+        if not (
+            self.data_specs.get("download_url")
+            and self.data_specs.get("download_multiple", False)
+        ):
+            # single files are read into memory, wget lists have unknown sizes
+            return None
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+            sizes = list(executor.map(_content_length, self._multiple_download_urls()))
+        if None in sizes:
+            return None
+        return sum(sizes)
+
     def _read_manual_download(self):
-        local_path = (
-            "/".join(os.getcwd().split("/")[:-1])
-            + "/"
-            + self.data_specs["raw_local_path"]
-        )
+        local_path = REPO_ROOT / self.data_specs["raw_local_path"]
         ds = xr.open_dataset(local_path, chunks={})
         self.var_attrs = ds[self.source_var_name].attrs
         return ds
@@ -98,32 +166,48 @@ class DownloadObservations:
         """Download data from URL(s)"""
         if self.data_specs.get("download_multiple", False):
             # Handle multiple file downloads
-            start_year = self.data_specs["file_date_range"][0]
-            end_year = self.data_specs["file_date_range"][1]
-
-            for year in range(start_year, end_year):
-                download_url = self.data_specs["download_url"].format(year)
-                temp_file_name = f"{temp_dir}/{download_url.split('/')[-1]}"
-                try:
-                    download_file(download_url, temp_file_name)
-                except Exception as e:
-                    logger.warning(f"Failed to download year {year}: {e}")
-
-            ds = xr.open_mfdataset(f"{temp_dir}/*", chunks={}).sel(
-                time=slice(HIST_START_DATE, SSP_END_DATE)
-            )
+            # yearly files are independent, download them concurrently
+            with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+                futures = {}
+                for download_url in self._multiple_download_urls():
+                    temp_file_name = f"{temp_dir}/{download_url.split('/')[-1]}"
+                    future = executor.submit(
+                        download_file, download_url, temp_file_name
+                    )
+                    futures[future] = download_url
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.warning(f"Failed to download {futures[future]}: {e}")
+
+            # yearly files share a grid, so open them in parallel and concatenate
+            # along time without comparing coordinates between files
+            ds = xr.open_mfdataset(
+                sorted(glob.glob(f"{temp_dir}/*.nc")),
+                chunks={},
+                parallel=True,
+                combine="nested",
+                concat_dim="time",
+                data_vars="minimal",
+                coords="minimal",
+                compat="override",
+                engine="h5netcdf",
+            ).sel(time=slice(HIST_START_DATE, SSP_END_DATE))
             ds = ds.resample(time="MS").mean()
         else:
-            # Single file download
-            temp_file_name = (
-                f"{temp_dir}/{self.data_specs['download_url'].split('/')[-1]}"
-            )
-
-            download_file(self.data_specs["download_url"], temp_file_name)
-
-            ds = xr.open_dataset(temp_file_name, chunks={}).sel(
-                time=slice(HIST_START_DATE, SSP_END_DATE)
-            )
+            # Single file download, read netCDF4/HDF5 from memory without a temp file
+            download_url = self.data_specs["download_url"]
+            buffer = download_to_buffer(download_url)
+            if buffer.getbuffer()[: len(HDF5_SIGNATURE)] == HDF5_SIGNATURE:
+                ds = xr.open_dataset(buffer, chunks={}, engine="h5netcdf")
+            else:
+                # other formats (e.g. netCDF3) are read from disk by their own backend
+                temp_file_name = f"{temp_dir}/{download_url.split('/')[-1]}"
+                with open(temp_file_name, "wb") as f:
+                    f.write(buffer.getbuffer())
+                ds = xr.open_dataset(temp_file_name, chunks={})
+            ds = ds.sel(time=slice(HIST_START_DATE, SSP_END_DATE))
 
         self.var_attrs = ds[self.source_var_name].attrs
         return ds
@@ -133,8 +217,7 @@ class DownloadObservations:
         logger.info(f"Downloading from GEE: {self.data_specs['gee_image_collection']}")
 
         try:
-            ee.Authenticate()
-            ee.Initialize(project=GOOGLE_CLOUD_PROJECT)
+            _ensure_ee_initialized()
 
             gee_images = ee.ImageCollection(self.data_specs["gee_image_collection"])
             dataset = gee_images.filterDate(HIST_START_DATE, SSP_END_DATE)
@@ -159,33 +242,47 @@ class DownloadObservations:
             logger.error("Wget download failed")
             raise RuntimeError("Wget download failed")
 
-        files = glob.glob(f"{temp_dir}/*")
-        ds_list = []
-
-        for file in files:
-            try:
-                # This logic is specific to your file naming convention
-                year = file.split(".")[1]
-                month = file.split(".")[2]
-                date = pd.to_datetime(f"{year}-{month}-01")
-                temp_ds = xr.open_dataset(file, decode_times=False, chunks={})
-                temp_ds = temp_ds.expand_dims({"time": [date]})
-                ds_list.append(temp_ds)
-            except Exception as e:
-                logger.warning(f"Failed to process file {file}: {e}")
-
-        if not ds_list:
+        files = sorted(glob.glob(f"{temp_dir}/*"))
+        # This logic is specific to your file naming convention: name.YYYY.MM...
+        name_parts = [os.path.basename(file).split(".") for file in files]
+        dates = pd.to_datetime(
+            [f"{p[1]}-{p[2]}-01" if len(p) > 2 else "" for p in name_parts],
+            format="%Y-%m-%d",
+            errors="coerce",
+        )
+        file_dates = {}
+        for file, date in zip(files, dates):
+            if pd.isna(date):
+                logger.warning(f"Failed to process file {file}: no year and month")
+            else:
+                file_dates[os.path.basename(file)] = date
+
+        if not file_dates:
             raise RuntimeError("No valid datasets from wget files")
 
-        ds = xr.concat(ds_list, dim="time")
-        self.var_attrs = ds_list[0][self.source_var_name].attrs
+        def add_time(ds):
+            date = file_dates[os.path.basename(ds.encoding["source"])]
+            return ds.expand_dims({"time": [date]})
+
+        # open files in parallel and concatenate along the new time dim in dask
+        ds = xr.open_mfdataset(
+            [f"{temp_dir}/{name}" for name in file_dates],
+            preprocess=add_time,
+            combine="nested",
+            concat_dim="time",
+            parallel=True,
+            decode_times=False,
+            chunks={},
+        )
+        self.var_attrs = ds[self.source_var_name].attrs
         return ds
 
     def anomaly_preprocess(self):
         """Preprocess anomaly data by adding climatology"""
         logger.info("Processing anomaly data with climatology")
 
-        with temporary_directory() as temp_dir:
+        climatology_url = self.data_specs["climatology_url"]
+        with temporary_directory(_content_length(climatology_url)) as temp_dir:
             clim_file_path = (
                 f"{temp_dir}/{self.data_specs['climatology_url'].split('/')[-1]}"
             )
@@ -197,13 +294,15 @@ class DownloadObservations:
             ds = ds.rename({"time": "month"})
             ds = standardize_dims(ds)
 
+            # expand the climatology to the data's time axis with one vectorized
+            # month lookup so the add is a single broadcast, not a groupby
+            clim_da = ds[self.data_specs["climatology_var_name"]].sel(
+                month=self.ds_raw["time"].dt.month
+            )
             self.ds_raw = (
-                (
-                    self.ds_raw[self.source_var_name].groupby("time.month")
-                    + ds[self.data_specs["climatology_var_name"]]
-                )
-                .to_dataset(name=self.source_var_name)
+                (self.ds_raw[self.source_var_name] + clim_da)
                 .drop_vars("month")
+                .to_dataset(name=self.source_var_name)
             )
 
             self.ds_raw[self.source_var_name].attrs["units"] = ds[
@@ -215,14 +314,17 @@ class DownloadObservations:
         logger.info("Creating error from land/water mask")
         ds = self.ds_raw.isel(time=0).squeeze().drop_vars("time", errors="ignore")
 
-        err_da = ds[self.source_var_name].where(ds[self.source_var_name] == 0, 1).T
-        err_abs_da = err_da * self.data_specs["error_values"]["ocean"]["absolute"]
-        err_ds = err_abs_da.where(
-            err_abs_da != 0, self.data_specs["error_values"]["land"]["absolute"]
+        error_values = self.data_specs["error_values"]
+        is_ocean = (ds[self.source_var_name] != 0).T
+        err_ds = xr.where(
+            is_ocean,
+            error_values["ocean"]["absolute"],
+            error_values["land"]["absolute"],
         ).to_dataset(name="absolute_error")
-        err_rel_da = err_da * self.data_specs["error_values"]["ocean"]["relative"]
-        err_ds["relative_error"] = err_rel_da.where(
-            err_rel_da != 0, self.data_specs["error_values"]["land"]["relative"]
+        err_ds["relative_error"] = xr.where(
+            is_ocean,
+            error_values["ocean"]["relative"],
+            error_values["land"]["relative"],
         )
 
         err_ds = err_ds.assign_coords(lon=(err_ds.lon % 360))
@@ -230,9 +332,7 @@ class DownloadObservations:
 
         # Read od550aer values
         local_var_path = (
-            "/".join(os.getcwd().split("/")[:-1])
-            + "/"
-            + OBSERVATION_DATA_SPECS[self.variable]["nasa_modis"]["local_path"]
+            REPO_ROOT / OBSERVATION_DATA_SPECS[self.variable]["nasa_modis"]["local_path"]
         )
         if os.path.exists(local_var_path):
             var_ds = xr.open_zarr(local_var_path, chunks={})
@@ -271,7 +371,13 @@ class DownloadObservations:
         ds = self.ds_raw[self.source_var_name].to_dataset(name=self.variable)
         ds = standardize_dims(ds)
         ds[self.variable].encoding = {}
-        ds = ds.chunk(chunks={"time": 1, "lat": -1, "lon": -1})
+        # float32 is ample precision for observations and halves bytes stored
+        ds[self.variable] = ds[self.variable].astype(np.float32)
+        # size time chunks to ~8 MiB so stores hold a few large objects
+        da = ds[self.variable]
+        step_bytes = da.sizes["lat"] * da.sizes["lon"] * da.dtype.itemsize
+        time_chunk = max(1, TARGET_CHUNK_BYTES // step_bytes)
+        ds = ds.chunk(chunks={"time": time_chunk, "lat": -1, "lon": -1})
 
         self.var_attrs["long_name"] = self.data_specs["long_name"]
         self.var_attrs["standard_name"] = self.data_specs["standard_name"]
@@ -288,45 +394,106 @@ class DownloadObservations:
         if self.ds_cleaned is None:
             self.standardize_data()
 
-        logger.info(f"Saving data locally: {self.local_data_path}")
-        self.ds_cleaned.to_zarr(self.local_data_path)
-
         if save_to_cloud:
-            logger.info(f"Uploading to cloud: {self.cloud_data_path}")
-            result = os.system(
-                f"gsutil -m cp -r {self.local_data_path} {self.cloud_data_path}"
+            # write straight to the bucket instead of staging a local copy
+            logger.info(f"Saving data to cloud: {self.cloud_data_path}")
+            self.ds_cleaned.to_zarr(
+                self.cloud_data_path,
+                mode="w",
+                consolidated=True,
+                storage_options={"project": GOOGLE_CLOUD_PROJECT},
             )
-            if result != 0:
-                logger.warning("Cloud upload failed")
+        else:
+            logger.info(f"Saving data locally: {self.local_data_path}")
+            self.ds_cleaned.to_zarr(self.local_data_path, mode="w", consolidated=True)
+
+
+def process_observations(variable: str, source: str, save_to_cloud: bool = False):
+    """Download, preprocess and save one observation dataset
+
+    Args:
+        variable (str): Climate variable to download
+        source (str): Data source
+        save_to_cloud (bool): Save to google cloud if passed. Default is False.
+    """
+    downloader = DownloadObservations(variable, source)
+    downloader.download_raw_data()
+
+    # Apply preprocessing based on source
+    if "climatology_url" in downloader.data_specs:  # source == "HadCRUT5":
+        print("anomaly processing")
+        downloader.anomaly_preprocess()
+    if source == "nasa_modis_error" and variable == "od550aer":
+        downloader.modis_od550aer_error_preprocess()
+
+    downloader.standardize_data()
+    downloader.save_data(save_to_cloud=save_to_cloud)
+    logger.info(f"Processing completed successfully: {variable}/{source}")
+
+
+def process_all_observations(save_to_cloud: bool = False):
+    """Process every (variable, source) pair in OBSERVATION_DATA_SPECS in parallel
+
+    Error datasets can read the processed main dataset (e.g. od550aer
+    nasa_modis_error), so main sources are processed first and error sources second.
+
+    Args:
+        save_to_cloud (bool): Save to google cloud if passed. Default is False.
+    """
+    pairs = [
+        (variable, source)
+        for variable, sources in OBSERVATION_DATA_SPECS.items()
+        for source in sources
+    ]
+    main_pairs = [pair for pair in pairs if not pair[1].endswith("_error")]
+    error_pairs = [pair for pair in pairs if pair[1].endswith("_error")]
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=min(8, len(pairs))) as executor:
+        for batch in [main_pairs, error_pairs]:
+            futures = {}
+            for variable, source in batch:
+                future = executor.submit(
+                    process_observations, variable, source, save_to_cloud
+                )
+                futures[future] = (variable, source)
+            for future in as_completed(futures):
+                variable, source = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Processing failed for {variable}/{source}: {e}")
+                    failed.append(f"{variable}/{source}")
+
+    if failed:
+        raise RuntimeError(f"Processing failed for: {', '.join(failed)}")
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Download and process observational climate data"
     )
+    parser.add_argument("--variable", help="Climate variable to download")
+    parser.add_argument("--source", help="Data source")
     parser.add_argument(
-        "--variable", required=True, help="Climate variable to download"
+        "--save_to_cloud", action="store_true", help="Upload to Google Cloud Storage"
     )
-    parser.add_argument("--source", required=True, help="Data source")
     parser.add_argument(
-        "--save_to_cloud", action="store_true", help="Upload to Google Cloud Storage"
+        "--batch",
+        action="store_true",
+        help="Process every variable and source in OBSERVATION_DATA_SPECS in parallel",
     )
 
     args = parser.parse_args()
 
-    downloader = DownloadObservations(args.variable, args.source)
-    downloader.download_raw_data()
-
-    # Apply preprocessing based on source
-    if "climatology_url" in downloader.data_specs:  # args.source == "HadCRUT5":
-        print("anomaly processing")
-        downloader.anomaly_preprocess()
-    if args.source == "nasa_modis_error" and args.variable == "od550aer":
-        downloader.modis_od550aer_error_preprocess()
-
-    downloader.standardize_data()
-    downloader.save_data(save_to_cloud=args.save_to_cloud)
-    logger.info("Processing completed successfully")
+    if args.batch:
+        process_all_observations(save_to_cloud=args.save_to_cloud)
+    elif args.variable is None or args.source is None:
+        parser.error("--variable and --source are required unless --batch is passed")
+    else:
+        process_observations(
+            args.variable, args.source, save_to_cloud=args.save_to_cloud
+        )
 
 
 if __name__ == "__main__":
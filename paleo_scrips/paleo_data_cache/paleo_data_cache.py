@@ -1,14 +1,23 @@
 import argparse
+import hashlib
 import logging
 import os
+import shlex
+import subprocess
 import sys
-import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
+import dask
 import numpy as np
 import xarray as xr
 
+MAX_DOWNLOAD_WORKERS = 8
+# models whose files fit in this budget are read into memory in one sequential pass
+MAX_IN_MEMORY_BYTES = 2 * 1024**3
+
 
 def setup_logging(log_level: str = "INFO", log_file: Optional[str] = None) -> None:
     """Set up logging configuration."""
@@ -25,10 +34,9 @@ def setup_logging(log_level: str = "INFO", log_file: Optional[str] = None) -> No
     )
 
 
-def find_model_folders(data_cache_dir: Path, paleo_period: str) -> List[str]:
+def find_model_folders(data_cache_dir: Path, paleo_period: str) -> List[Path]:
     """Find model folders containing wget scripts for the specified period."""
-    search_pattern = data_cache_dir / "*" / f"{paleo_period}*.sh"
-    model_folders = glob.glob(str(search_pattern))
+    model_folders = sorted(data_cache_dir.glob(f"*/{paleo_period}*.sh"))
     
     logging.info(f"Found {len(model_folders)} model folders for period '{paleo_period}'")
     for folder in model_folders:
@@ -37,15 +45,95 @@ def find_model_folders(data_cache_dir: Path, paleo_period: str) -> List[str]:
     return model_folders
 
 
+def parse_wget_script(wget_file: str) -> List[Tuple[str, str, str, str]]:
+    """Parse the (file, url, checksum type, checksum) entries of an ESGF wget script."""
+    entries = []
+    in_file_list = False
+    with open(wget_file) as f:
+        for line in f:
+            if not in_file_list:
+                in_file_list = line.startswith("download_files=") and "<<EOF--dataset" in line
+                continue
+            if line.startswith("EOF--dataset"):
+                break
+            try:
+                fields = shlex.split(line)
+            except ValueError:
+                logging.warning(f"Skipping unparsable line in {wget_file}: {line.strip()}")
+                continue
+            if len(fields) == 4:
+                entries.append(tuple(fields))
+    return entries
+
+
+def file_checksum(file_path: str, chksum_type: str) -> str:
+    """Compute the hex digest of a file in 1 MiB blocks."""
+    digest = hashlib.new(chksum_type.lower())
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_wget_entry(model_dir: str, entry: Tuple[str, str, str, str]) -> bool:
+    """Download a single wget script entry into model_dir and verify its checksum.
+
+    Failed or corrupt downloads are removed, so the next run fetches them again
+    instead of wget -c treating them as complete.
+    """
+    file, url, chksum_type, chksum = entry
+    file_path = os.path.join(model_dir, os.path.basename(file))
+
+    try:
+        result = subprocess.run(["wget", "-q", "-c", "--tries=3", "-O", file_path, url], check=False)
+        if result.returncode != 0:
+            logging.error(f"Download of {url} failed with exit code: {result.returncode}")
+            remove_partial_file(file_path)
+            return False
+        # older ESGF scripts leave the checksum fields empty
+        if not (chksum_type and chksum):
+            logging.warning(f"No checksum listed for {file_path}, skipping verification")
+        elif file_checksum(file_path, chksum_type) != chksum.lower():
+            logging.error(f"Checksum mismatch for {file_path}")
+            remove_partial_file(file_path)
+            return False
+    except Exception as e:
+        logging.error(f"Error downloading {url}: {e}")
+        remove_partial_file(file_path)
+        return False
+
+    logging.debug(f"Downloaded: {file_path}")
+    return True
+
+
+def remove_partial_file(file_path: str) -> None:
+    """Remove a failed download if it exists."""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
 def download_data(wget_file: str) -> bool:
     """Download data using wget script."""
     logging.info(f"Downloading data using script: {wget_file}")
-    
+
+    # fetch the listed files concurrently instead of one at a time through the script
+    entries = parse_wget_script(wget_file)
+    if entries:
+        model_dir = os.path.dirname(wget_file)
+        logging.info(f"Downloading {len(entries)} files with {MAX_DOWNLOAD_WORKERS} workers")
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+            results = list(executor.map(lambda entry: download_wget_entry(model_dir, entry), entries))
+        if all(results):
+            logging.info("Data download completed successfully")
+            return True
+        logging.error(f"{results.count(False)} of {len(entries)} downloads failed")
+        return False
+
     try:
-        # Make script executable
-        os.system(f"chmod +x {wget_file}")
-        # Execute download script
-        exit_code = os.system(f"{wget_file}")
+        # Execute download script through bash, so it does not need to be executable
+        exit_code = subprocess.run(["bash", wget_file], check=False).returncode
         
         if exit_code == 0:
             logging.info("Data download completed successfully")
@@ -58,28 +146,45 @@ def download_data(wget_file: str) -> bool:
         return False
 
 
-def load_netcdf_files(model_dir: str) -> Optional[xr.Dataset]:
+def list_temperature_files(model_dir: str) -> List[str]:
+    """List the temperature NetCDF files in a model directory with a single scan."""
+    with os.scandir(model_dir) as entries:
+        return sorted(entry.path for entry in entries if entry.name.startswith("tas"))
+
+
+def load_netcdf_files(nc_files: List[str]) -> Optional[xr.Dataset]:
     """Load and merge NetCDF files with temperature data."""
-    nc_files = glob.glob(f"{model_dir}tas*")
-    
     if not nc_files:
-        logging.warning(f"No temperature files found in {model_dir}")
         return None
     
     logging.info(f"Loading {len(nc_files)} NetCDF files")
     
     # Variables to drop if they exist
     drop_vars = ["time_bnds", "lat_bnds", "lon_bnds", "height"]
+    # open files concurrently and only concatenate variables that carry time
+    open_kwargs = dict(
+        parallel=True,
+        combine="by_coords",
+        chunks={"time": 120},
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        drop_variables=drop_vars,
+    )
+    total_bytes = sum(os.path.getsize(file) for file in nc_files)
+    if total_bytes < MAX_IN_MEMORY_BYTES:
+        # the HDF5 core driver serves metadata and chunk reads from RAM
+        open_kwargs.update(engine="h5netcdf", backend_kwargs={"driver": "core"})
     
     try:
         # First attempt without cftime
-        ds = xr.open_mfdataset(nc_files, chunks={}).drop_vars(drop_vars, errors="ignore")
+        ds = xr.open_mfdataset(nc_files, **open_kwargs)
         logging.info("Successfully loaded dataset without cftime")
     except Exception as e:
         logging.warning(f"Failed to load without cftime: {e}")
         try:
             # Second attempt with cftime for non-standard calendars
-            ds = xr.open_mfdataset(nc_files, use_cftime=True, chunks={}).drop_vars(drop_vars, errors="ignore")
+            ds = xr.open_mfdataset(nc_files, use_cftime=True, **open_kwargs)
             logging.info("Successfully loaded dataset with cftime")
         except Exception as e2:
             logging.error(f"Failed to load dataset: {e2}")
@@ -88,15 +193,42 @@ def load_netcdf_files(model_dir: str) -> Optional[xr.Dataset]:
     return ds
 
 
-def calculate_area_weights(ds: xr.Dataset) -> xr.Dataset:
-    """Calculate area weights based on latitude."""
+@lru_cache(maxsize=16)
+def cos_lat_weights(lats: Tuple[float, ...]) -> np.ndarray:
+    """Cosine latitude weights, cached since models share a handful of grids."""
+    weights = np.cos(np.deg2rad(np.asarray(lats, dtype="float32")))
+    weights.flags.writeable = False
+    return weights
+
+
+def calculate_area_weights(ds: xr.Dataset) -> xr.DataArray:
+    """Calculate area weights based on latitude.
+
+    The weights only vary with latitude, so they are kept 1-D and broadcast
+    against lon by xarray's weighted reductions.
+    """
     logging.info("Calculating area weights")
-    weights = np.cos(np.deg2rad(ds.lat))
-    weights = weights.expand_dims({"lon": ds.lon})
-    weights.name = "areacella"
+    weights = xr.DataArray(
+        cos_lat_weights(tuple(ds.lat.values.tolist())), coords={"lat": ds.lat}, dims="lat", name="areacella"
+    )
     return weights
 
 
+def build_netcdf_encoding(ds: xr.Dataset) -> dict:
+    """Build compressed float32 encoding with one chunk per month/field."""
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if var.ndim == 0 or not np.issubdtype(var.dtype, np.floating):
+            continue
+        encoding[name] = {
+            "zlib": True,
+            "complevel": 3,
+            "dtype": "float32",
+            "chunksizes": tuple(1 if dim == "month" else size for dim, size in var.sizes.items()),
+        }
+    return encoding
+
+
 def process_temperature_data(ds: xr.Dataset, model_dir: str, paleo_period: str) -> None:
     """Process temperature data and save annual and monthly statistics."""
     logging.info("Processing temperature data")
@@ -104,28 +236,35 @@ def process_temperature_data(ds: xr.Dataset, model_dir: str, paleo_period: str)
     # Calculate area weights
     weights = calculate_area_weights(ds)
     
-    # Annual statistics
-    logging.info("Calculating annual mean and standard deviation")
-    ds_mean_annual = ds.mean(dim="time")
-    ds_std_annual = ds.std(dim="time").rename({"tas": "tas_std"})
+    # computing all four statistics together lets dask read each input chunk once
+    logging.info("Calculating annual and monthly mean and standard deviation")
+    # flox reduces all months in one vectorized pass instead of looping per group
+    with xr.set_options(use_flox=True):
+        monthly = ds.groupby("time.month")
+        ds_mean_annual, ds_std_annual, ds_mean_mon, ds_std_mon = dask.compute(
+            ds.mean(dim="time"), ds.std(dim="time"), monthly.mean(), monthly.std()
+        )
+    ds_std_annual = ds_std_annual.rename({"tas": "tas_std"})
+    ds_std_mon = ds_std_mon.rename({"tas": "tas_std"})
     
     annual_output = f"{model_dir}{paleo_period}_tas_annual.nc"
     logging.info(f"Saving annual statistics to: {annual_output}")
-    xr.merge([ds_mean_annual, ds_std_annual, weights.to_dataset(name="weight")]).to_netcdf(annual_output)
-    
-    # Monthly statistics
-    logging.info("Calculating monthly mean and standard deviation")
-    ds_mean_mon = ds.groupby("time.month").mean()
-    ds_std_mon = ds.groupby("time.month").std().rename({"tas": "tas_std"})
+    # the statistics share coordinates by construction, so skip merge's alignment
+    annual_ds = xr.Dataset(
+        {"tas": ds_mean_annual["tas"], "tas_std": ds_std_annual["tas_std"], "weight": weights}
+    )
+    annual_ds.to_netcdf(annual_output, engine="h5netcdf", encoding=build_netcdf_encoding(annual_ds))
     
     monthly_output = f"{model_dir}{paleo_period}_tas_monthly.nc"
     logging.info(f"Saving monthly statistics to: {monthly_output}")
-    xr.merge([ds_mean_mon, ds_std_mon, weights.to_dataset(name="weight")]).to_netcdf(monthly_output)
+    monthly_ds = xr.Dataset(
+        {"tas": ds_mean_mon["tas"], "tas_std": ds_std_mon["tas_std"], "weight": weights}
+    )
+    monthly_ds.to_netcdf(monthly_output, engine="h5netcdf", encoding=build_netcdf_encoding(monthly_ds))
 
 
-def cleanup_files(model_dir: str) -> None:
+def cleanup_files(nc_files: List[str]) -> None:
     """Remove temporary NetCDF files after processing."""
-    nc_files = glob.glob(f"{model_dir}tas*")
     logging.info(f"Cleaning up {len(nc_files)} temporary files")
     
     for file in nc_files:
@@ -139,18 +278,30 @@ def cleanup_files(model_dir: str) -> None:
 def download_eocene_data() -> None:
     """Handle special case for Eocene data download."""
     logging.info("Downloading Eocene data via direct wget")
-    wget_command = (
-        'wget -e robots=off --mirror --no-parent -r --accept "tas_*mean.nc" '
-        'https://dap.ceda.ac.uk/badc/cmip6/data/CMIP6Plus/DeepMIP/deepmip-eocene-p1/'
-    )
+    wget_command = [
+        "wget", "-e", "robots=off", "--mirror", "--no-parent", "-r", "--accept", "tas_*mean.nc",
+        "https://dap.ceda.ac.uk/badc/cmip6/data/CMIP6Plus/DeepMIP/deepmip-eocene-p1/",
+    ]
     
-    exit_code = os.system(wget_command)
+    exit_code = subprocess.run(wget_command, check=False).returncode
     if exit_code == 0:
         logging.info("Eocene data download completed successfully")
     else:
         logging.error(f"Eocene data download failed with exit code: {exit_code}")
 
 
+def is_processed(wget_file: Path, paleo_period: str) -> bool:
+    """Check whether both outputs exist and are newer than the wget script."""
+    script_mtime = wget_file.stat().st_mtime
+    for frequency in ["annual", "monthly"]:
+        try:
+            if os.stat(wget_file.parent / f"{paleo_period}_tas_{frequency}.nc").st_mtime <= script_mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
 def process_paleo_period(data_cache_dir: Path, paleo_period: str, skip_download: bool = False) -> None:
     """Process data for a specific paleoclimate period."""
     logging.info(f"Processing paleoclimate period: {paleo_period}")
@@ -169,31 +320,42 @@ def process_paleo_period(data_cache_dir: Path, paleo_period: str, skip_download:
     
     # Process each model
     for wget_file in model_folders:
-        model_dir = "/".join(wget_file.split("/")[:-1]) + "/"
-        model_name = Path(wget_file).parent.name
+        model_dir = f"{wget_file.parent}/"
+        model_name = wget_file.parent.name
         logging.info(f"Processing model: {model_name}")
         
+        # Skip models whose outputs are newer than their wget script
+        if is_processed(wget_file, paleo_period):
+            logging.info(f"Skipping model {model_name}, outputs are up to date")
+            continue
+        
         # Download data unless skipped
         if not skip_download:
-            if not download_data(wget_file):
+            if not download_data(str(wget_file)):
                 logging.error(f"Skipping model {model_name} due to download failure")
                 continue
         
         # Load and process data
-        ds = load_netcdf_files(model_dir)
+        nc_files = list_temperature_files(model_dir)
+        if not nc_files:
+            logging.warning(f"No temperature files found in {model_dir}")
+        ds = load_netcdf_files(nc_files)
         if ds is None:
             logging.error(f"Skipping model {model_name} due to data loading failure")
             continue
         
         try:
-            process_temperature_data(ds, model_dir, paleo_period)
+            # keep one set of file handles open for the reductions and close them
+            # before the inputs are cleaned up
+            with ds:
+                process_temperature_data(ds, model_dir, paleo_period)
             logging.info(f"Successfully processed model: {model_name}")
         except Exception as e:
             logging.error(f"Failed to process model {model_name}: {e}")
             continue
         finally:
             if not skip_download:
-                cleanup_files(model_dir)
+                cleanup_files(nc_files)
 
 
 def main() -> None:
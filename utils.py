@@ -1,13 +1,30 @@
+import io
 import logging
+import shutil
 
 import dask.array as da
 import numpy as np
 import pandas as pd
 import requests
 import xarray as xr
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+# shared session so repeated downloads from the same host reuse connections
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# one map per time step, split into tiles so readers of a region fetch one chunk
+DEFAULT_ZARR_CHUNKS = {"time": 1, "lat": 180, "lon": 360}
+
 
 def standardize_dims(ds: xr.Dataset, reset_coorinates: bool = False) -> xr.Dataset:
     """Fixes common problems with xarray datasets
@@ -54,8 +71,17 @@ def standardize_dims(ds: xr.Dataset, reset_coorinates: bool = False) -> xr.Datas
     # fix time
     if "time" in ds.dims:
         # try:
-        ds["time"] = pd.to_datetime(ds["time"].dt.strftime("%Y-%m-01"))
-        ds = ds.sortby("time")  # make sure its in the right order before slicing
+        if np.issubdtype(ds["time"].dtype, np.datetime64):
+            # truncate to the first of the month without a string round trip
+            ds["time"] = (
+                ds["time"].values.astype("datetime64[M]").astype("datetime64[ns]")
+            )
+        else:
+            # cftime calendars
+            ds["time"] = pd.to_datetime(ds["time"].dt.strftime("%Y-%m-01"))
+        # make sure its in the right order before slicing, sorting only if needed
+        if not ds.indexes["time"].is_monotonic_increasing:
+            ds = ds.sortby("time")
         # except AttributeError:
         #     # berkeley BEST dataset time in format year.month fraction (i.e. 2024.958333 == 2024/12)
         #     years = ds["time"].astype(int)
@@ -67,9 +93,27 @@ def standardize_dims(ds: xr.Dataset, reset_coorinates: bool = False) -> xr.Datas
     if (len(ds["lat"].dims) == 1) and (len(ds["lon"].dims) == 1):
         # Shift longitudes
         ds = ds.assign_coords(lon=(ds.lon % 360))
-        ds = ds.sortby("lon")
 
-        ds = ds.sortby("lat")
+        # sort lat and lon with a single indexing call, skipped if already sorted
+        indexers = {}
+        shifts = {}
+        for dim in ["lon", "lat"]:
+            values = ds[dim].values
+            if np.all(values[1:] < values[:-1]):
+                # descending axes (e.g. lat 90 -> -90) only need a reversed view
+                indexers[dim] = slice(None, None, -1)
+            elif np.any(values[1:] < values[:-1]):
+                shift = int(np.argmin(values))
+                if np.all(np.diff(np.roll(values, -shift)) > 0):
+                    # a -180..180 grid wrapped to 0..360 is a rotation, which roll
+                    # does with two contiguous slices instead of a gather
+                    shifts[dim] = -shift
+                else:
+                    indexers[dim] = np.argsort(values, kind="stable")
+        if shifts:
+            ds = ds.roll(shifts, roll_coords=True)
+        if indexers:
+            ds = ds.isel(indexers)
 
         if reset_coorinates:
             # fix coordinates
@@ -77,8 +121,9 @@ def standardize_dims(ds: xr.Dataset, reset_coorinates: bool = False) -> xr.Datas
             lon_len = len(ds.lon)
             lat_res = 180 / lat_len
             lon_res = 360 / lon_len
-            lats = np.arange(-90 + lat_res / 2, 90, lat_res)
-            lons = np.arange(lon_res / 2, 360, lon_res)
+            # linspace always gives exactly lat_len/lon_len cell centres
+            lats = np.linspace(-90 + lat_res / 2, 90 - lat_res / 2, lat_len)
+            lons = np.linspace(lon_res / 2, 360 - lon_res / 2, lon_len)
             ds = ds.assign_coords({"lat": lats, "lon": lons})
 
     else:
@@ -91,7 +136,9 @@ def standardize_dims(ds: xr.Dataset, reset_coorinates: bool = False) -> xr.Datas
         test_lons = ds["lon"].isel(j=sample_idx)
 
         # and that lon is 0 - 360
-        ds["lon"] = ds["lon"] % 360
+        # 2D lon can be dask backed, wrap the small coordinate eagerly in numpy
+        lon = ds["lon"]
+        ds = ds.assign_coords(lon=(lon.dims, np.mod(lon.values, 360), lon.attrs))
         if test_lons["lon"][0] != 0:
             # for sorting purposes
             ds = ds.assign_coords(i=test_lons["lon"].values)
@@ -102,7 +149,14 @@ def standardize_dims(ds: xr.Dataset, reset_coorinates: bool = False) -> xr.Datas
     return ds
 
 
-def build_zarr_store(var_name: str, dims_dict: dict, attributes: dict, store_path: str):
+def build_zarr_store(
+    var_name: str,
+    dims_dict: dict,
+    attributes: dict,
+    store_path: str,
+    dtype: str = "float32",
+    chunk_overrides: dict = None,
+):
     """Build the template for the zarr file that will be populated with data later on
 
     Args:
@@ -110,13 +164,18 @@ def build_zarr_store(var_name: str, dims_dict: dict, attributes: dict, store_pat
         dims_dict (dict): dictionairy with dimesion names as keys and dimension values as items
         attributes (dict): dataset attribures
         store_path (str): where to save data
+        dtype (str): data type of the stored variable. Defaults to "float32".
+        chunk_overrides (dict): chunk size per dimension, merged over DEFAULT_ZARR_CHUNKS.
+            Dimensions missing from both are stored as a single chunk. Defaults to None.
     """
+    chunks = {**DEFAULT_ZARR_CHUNKS, **(chunk_overrides or {})}
     array_size = []
     chunk_size = []
     for key, item in dims_dict.items():
         array_size.append(len(item))
-        chunk_size.append(1) if key == "time" else chunk_size.append(-1)
-    data = da.zeros(array_size, chunks=(chunk_size))
+        chunk_size.append(chunks.get(key, -1))
+    # values are never written (compute=False), so skip filling the template
+    data = da.empty(array_size, chunks=(chunk_size), dtype=dtype)
     # Build dataset
     ds = xr.Dataset(
         data_vars={var_name: (dims_dict.keys(), data)},
@@ -132,13 +191,30 @@ def download_file(url: str, output_path: str) -> None:
     """Download a file with basic error handling"""
     logger.info(f"Downloading {url}")
     try:
-        with requests.get(url, stream=True, timeout=300) as response:
+        with SESSION.get(url, stream=True, timeout=300) as response:
             response.raise_for_status()
+            # decode any content-encoding so the raw stream matches iter_content
+            response.raw.decode_content = True
             with open(output_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+                shutil.copyfileobj(response.raw, f, length=1024 * 1024)
         logger.info(f"Download completed: {output_path}")
     except Exception as e:
         logger.error(f"Download failed: {e}")
         raise
+
+
+def download_to_buffer(url: str) -> io.BytesIO:
+    """Download a file into memory with basic error handling"""
+    logger.info(f"Downloading {url}")
+    buffer = io.BytesIO()
+    try:
+        with SESSION.get(url, stream=True, timeout=300) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, buffer, length=1024 * 1024)
+        logger.info(f"Download completed: {url}")
+    except Exception as e:
+        logger.error(f"Download failed: {e}")
+        raise
+    buffer.seek(0)
+    return buffer